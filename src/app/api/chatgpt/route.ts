@@ -5,13 +5,103 @@ import { StreamingTextResponse, LangChainStream } from "ai";
 import clerk from "@clerk/clerk-sdk-node";
 import { CallbackManager } from "langchain/callbacks";
 import { PromptTemplate } from "langchain/prompts";
+import { LLMResult } from "langchain/schema";
 import { NextResponse } from "next/server";
 import { currentUser } from "@clerk/nextjs";
 import MemoryManager from "@/app/utils/memory";
+import { loadCompanionFile } from "@/app/utils/companionFile";
 import { rateLimit } from "@/app/utils/rateLimit";
+import { llmSemaphore } from "@/app/utils/semaphore";
+import TTLCache, { hashCacheKey, responseCache } from "@/app/utils/cache";
 
 dotenv.config({ path: `.env.local` });
 
+// Only {relevantHistory} and {recentChatHistory} are passed as values at call
+// time. The fixed values ({name}, {userName}, {preamble}, {replyLimit}) are
+// rendered into the template text with their braces escaped; see
+// getCompanionChain.
+const chainPromptTemplate = `
+    You are {name} and are currently talking to {userName}.
+
+    {preamble}
+
+  You reply with answers that range from one sentence to one paragraph and with some details. {replyLimit}
+
+  Below are relevant details about {name}'s past
+  {relevantHistory}
+  
+  Below is a relevant conversation history
+
+  {recentChatHistory}`;
+
+// The model holds no per-user state, so one instance serves every request.
+// Streaming handlers are passed per call instead of at construction.
+const model = new OpenAI({
+  streaming: true,
+  modelName: "gpt-3.5-turbo-16k",
+  openAIApiKey: process.env.OPENAI_API_KEY,
+});
+// Set LLM_VERBOSE=true to log every prompt and completion for debugging
+model.verbose = process.env.LLM_VERBOSE === "true";
+
+type CompanionChain = {
+  preamble: string;
+  chain: LLMChain;
+};
+
+// One chain per companion, user and reply limit; bounded because the number
+// of users is not.
+const companionChains = new TTLCache<CompanionChain>(1024, 60 * 60 * 1000);
+
+function escapeTemplate(text: string): string {
+  return text.replace(/{/g, "{{").replace(/}/g, "}}");
+}
+
+// Everything in the prompt except the retrieved and recent history is fixed
+// for a given companion, user and channel, so that part is rendered into the
+// template once; each call then only fills in the two history variables. The
+// chain is rebuilt if the companion file (and so its preamble) changes.
+function getCompanionChain(
+  name: string,
+  userName: string,
+  replyLimit: string,
+  preamble: string
+): LLMChain {
+  const key = JSON.stringify([name, userName, replyLimit]);
+  const cached = companionChains.get(key);
+  if (cached && cached.preamble === preamble) {
+    return cached.chain;
+  }
+
+  // A single pass, so placeholder-like text inside one value is never
+  // substituted by a later replacement.
+  const fixedValues: Record<string, string> = {
+    name,
+    userName,
+    preamble,
+    replyLimit,
+  };
+  const template = chainPromptTemplate.replace(
+    /{(name|userName|preamble|replyLimit)}/g,
+    (_, variable: string) => escapeTemplate(fixedValues[variable])
+  );
+  const chain = new LLMChain({
+    llm: model,
+    prompt: PromptTemplate.fromTemplate(template),
+  });
+  companionChains.set(key, { preamble, chain });
+  return chain;
+}
+
+function textToStream(text: string): ReadableStream {
+  return new ReadableStream({
+    start(controller) {
+      controller.enqueue(new TextEncoder().encode(text));
+      controller.close();
+    },
+  });
+}
+
 export async function POST(req: Request) {
   let clerkUserId;
   let user;
@@ -37,7 +127,9 @@ export async function POST(req: Request) {
   const name = req.headers.get("name");
   const companionFileName = name + ".txt";
 
-  console.log("prompt: ", prompt);
+  if (process.env.LLM_VERBOSE === "true") {
+    console.log("prompt: ", prompt);
+  }
   if (isText) {
     clerkUserId = userId;
     clerkUserName = userName;
@@ -60,19 +152,7 @@ export async function POST(req: Request) {
     );
   }
 
-  // Load character "PREAMBLE" from character file. These are the core personality
-  // characteristics that are used in every prompt. Additional background is
-  // only included if it matches a similarity comparioson with the current
-  // discussion. The PREAMBLE should include a seed conversation whose format will
-  // vary by the model using it.
-  const fs = require("fs").promises;
-  const data = await fs.readFile("companions/" + companionFileName, "utf8");
-
-  // Clunky way to break out PREAMBLE and SEEDCHAT from the character file
-  const presplit = data.split("###ENDPREAMBLE###");
-  const preamble = presplit[0];
-  const seedsplit = presplit[1].split("###ENDSEEDCHAT###");
-  const seedchat = seedsplit[0];
+  const { preamble, seedchat } = await loadCompanionFile(companionFileName);
 
   const companionKey = {
     companionName: name!,
@@ -86,8 +166,37 @@ export async function POST(req: Request) {
     await memoryManager.seedChatHistory(seedchat, "\n\n", companionKey);
   }
 
-  await memoryManager.writeToHistory("Human: " + prompt + "\n", companionKey);
-  let recentChatHistory = await memoryManager.readLatestHistory(companionKey);
+  let recentChatHistory = await memoryManager.writeAndReadLatestHistory(
+    "Human: " + prompt + "\n",
+    companionKey
+  );
+
+  const replyWithTwilioLimit = isText
+    ? "You reply within 1000 characters."
+    : "";
+
+  const responseCacheKey = hashCacheKey(
+    "chatgpt",
+    name!,
+    preamble,
+    clerkUserName || "",
+    replyWithTwilioLimit,
+    recentChatHistory
+  );
+  const cachedResponse = responseCache.get(responseCacheKey);
+  if (process.env.LLM_VERBOSE === "true") {
+    const { hits, misses } = responseCache.stats();
+    console.log(
+      `INFO: response cache ${cachedResponse ? "hit" : "miss"} (hits: ${hits}, misses: ${misses})`
+    );
+  }
+  if (cachedResponse) {
+    await memoryManager.writeToHistory(cachedResponse + "\n", companionKey);
+    if (isText) {
+      return NextResponse.json(cachedResponse);
+    }
+    return new StreamingTextResponse(textToStream(cachedResponse));
+  }
 
   // query Pinecone
   const similarDocs = await memoryManager.vectorSearch(
@@ -97,57 +206,66 @@ export async function POST(req: Request) {
 
   let relevantHistory = "";
   if (!!similarDocs && similarDocs.length !== 0) {
-    relevantHistory = similarDocs.map((doc) => doc.pageContent).join("\n");
+    // Drop exact duplicates, e.g. the same chunk stored twice after the index
+    // script was re-run (Pinecone assigns new random IDs on each run).
+    const pageContents = new Set(similarDocs.map((doc) => doc.pageContent));
+    relevantHistory = Array.from(pageContents).join("\n");
   }
 
   const { stream, handlers } = LangChainStream();
 
-  const model = new OpenAI({
-    streaming: true,
-    modelName: "gpt-3.5-turbo-16k",
-    openAIApiKey: process.env.OPENAI_API_KEY,
-    callbackManager: CallbackManager.fromHandlers(handlers),
-  });
-  model.verbose = true;
-
-  const replyWithTwilioLimit = isText
-    ? "You reply within 1000 characters."
-    : "";
-
-  const chainPrompt = PromptTemplate.fromTemplate(`
-    You are ${name} and are currently talking to ${clerkUserName}.
-
-    ${preamble}
-
-  You reply with answers that range from one sentence to one paragraph and with some details. ${replyWithTwilioLimit}
-
-  Below are relevant details about ${name}'s past
-  ${relevantHistory}
-  
-  Below is a relevant conversation history
-
-  ${recentChatHistory}`);
-
-  const chain = new LLMChain({
-    llm: model,
-    prompt: chainPrompt,
-  });
+  // Save the reply before LangChainStream closes the response, so a quick
+  // follow-up turn already finds it in history.
+  const callbackHandlers = {
+    ...handlers,
+    handleLLMEnd: async (output: LLMResult, runId: string) => {
+      try {
+        const text = output.generations[0][0].text;
+        responseCache.set(responseCacheKey, text);
+        await memoryManager.writeToHistory(text + "\n", companionKey);
+      } catch (err) {
+        console.log("WARNING: failed to write reply to history.", err);
+      } finally {
+        await handlers.handleLLMEnd(output, runId);
+      }
+    },
+  };
 
-  const result = await chain
-    .call({
-      relevantHistory,
-      recentChatHistory: recentChatHistory,
-    })
-    .catch(console.error);
+  // Tokens reach the client through the LangChainStream handlers as they are
+  // generated, so the browser response is returned without awaiting this.
+  const completion = llmSemaphore
+    .run(() =>
+      getCompanionChain(
+        name!,
+        clerkUserName || "",
+        replyWithTwilioLimit,
+        preamble
+      ).call(
+        {
+          relevantHistory,
+          recentChatHistory: recentChatHistory,
+        },
+        CallbackManager.fromHandlers(callbackHandlers)
+      )
+    )
+    .catch((err) => {
+      console.error("ERROR: LLM chain call failed.", err);
+    });
 
-  console.log("result", result);
-  const chatHistoryRecord = await memoryManager.writeToHistory(
-    result!.text + "\n",
-    companionKey
-  );
-  console.log("chatHistoryRecord", chatHistoryRecord);
   if (isText) {
-    return NextResponse.json(result!.text);
+    const result = await completion;
+    if (!result) {
+      return new NextResponse(
+        JSON.stringify({ Message: "The companion failed to reply." }),
+        {
+          status: 500,
+          headers: {
+            "Content-Type": "application/json",
+          },
+        }
+      );
+    }
+    return NextResponse.json(result.text);
   }
   return new StreamingTextResponse(stream);
 }
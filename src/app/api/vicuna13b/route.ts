@@ -4,12 +4,38 @@ import { Replicate } from "langchain/llms/replicate";
 import { CallbackManager } from "langchain/callbacks";
 import clerk from "@clerk/clerk-sdk-node";
 import MemoryManager from "@/app/utils/memory";
+import { loadCompanionFile } from "@/app/utils/companionFile";
 import { currentUser } from "@clerk/nextjs";
 import { NextResponse } from "next/server";
 import { rateLimit } from "@/app/utils/rateLimit";
+import { llmSemaphore } from "@/app/utils/semaphore";
+import { hashCacheKey, responseCache } from "@/app/utils/cache";
 
 dotenv.config({ path: `.env.local` });
 
+// One Replicate client serves every request; per-request callbacks are passed
+// to model.call.
+const model = new Replicate({
+  model:
+    "replicate/vicuna-13b:6282abe6a492de4145d7bb601023762212f9ddbbe78278bd6771c8b3b2f2a13b",
+  input: {
+    max_length: 2048,
+  },
+  apiKey: process.env.REPLICATE_API_TOKEN,
+});
+
+// Set LLM_VERBOSE=true to log every prompt and completion for debugging
+model.verbose = process.env.LLM_VERBOSE === "true";
+
+function textToStream(text: string) {
+  var Readable = require("stream").Readable;
+
+  let s = new Readable();
+  s.push(text);
+  s.push(null);
+  return s;
+}
+
 export async function POST(request: Request) {
   const { prompt, isText, userId, userName } = await request.json();
   let clerkUserId;
@@ -56,19 +82,7 @@ export async function POST(request: Request) {
     );
   }
 
-  // Load character "PREAMBLE" from character file. These are the core personality
-  // characteristics that are used in every prompt. Additional background is
-  // only included if it matches a similarity comparioson with the current
-  // discussion. The PREAMBLE should include a seed conversation whose format will
-  // vary by the model using it.
-  const fs = require("fs").promises;
-  const data = await fs.readFile("companions/" + companion_file_name, "utf8");
-
-  // Clunky way to break out PREAMBLE and SEEDCHAT from the character file
-  const presplit = data.split("###ENDPREAMBLE###");
-  const preamble = presplit[0];
-  const seedsplit = presplit[1].split("###ENDSEEDCHAT###");
-  const seedchat = seedsplit[0];
+  const { preamble, seedchat } = await loadCompanionFile(companion_file_name);
 
   const companionKey = {
     companionName: name!,
@@ -83,14 +97,33 @@ export async function POST(request: Request) {
   if (records.length === 0) {
     await memoryManager.seedChatHistory(seedchat, "\n\n", companionKey);
   }
-  await memoryManager.writeToHistory(
+  let recentChatHistory = await memoryManager.writeAndReadLatestHistory(
     "### Human: " + prompt + "\n",
     companionKey
   );
 
-  // Query Pinecone
+  const responseCacheKey = hashCacheKey(
+    "vicuna13b",
+    name!,
+    preamble,
+    recentChatHistory
+  );
+  const cachedResponse = responseCache.get(responseCacheKey);
+  if (process.env.LLM_VERBOSE === "true") {
+    const { hits, misses } = responseCache.stats();
+    console.log(
+      `INFO: response cache ${cachedResponse ? "hit" : "miss"} (hits: ${hits}, misses: ${misses})`
+    );
+  }
+  if (cachedResponse) {
+    await memoryManager.writeToHistory(
+      "### " + cachedResponse.trim(),
+      companionKey
+    );
+    return new StreamingTextResponse(textToStream(cachedResponse));
+  }
 
-  let recentChatHistory = await memoryManager.readLatestHistory(companionKey);
+  // Query Pinecone
 
   // Right now the preamble is included in the similarity search, but that
   // shouldn't be an issue
@@ -102,26 +135,16 @@ export async function POST(request: Request) {
 
   let relevantHistory = "";
   if (!!similarDocs && similarDocs.length !== 0) {
-    relevantHistory = similarDocs.map((doc) => doc.pageContent).join("\n");
+    // Drop exact duplicates, e.g. the same chunk stored twice after the index
+    // script was re-run (Pinecone assigns new random IDs on each run).
+    const pageContents = new Set(similarDocs.map((doc) => doc.pageContent));
+    relevantHistory = Array.from(pageContents).join("\n");
   }
 
   // Call Replicate for inference
-  const model = new Replicate({
-    model:
-      "replicate/vicuna-13b:6282abe6a492de4145d7bb601023762212f9ddbbe78278bd6771c8b3b2f2a13b",
-    input: {
-      max_length: 2048,
-    },
-    apiKey: process.env.REPLICATE_API_TOKEN,
-    callbackManager: CallbackManager.fromHandlers(handlers),
-  });
-
-  // Turn verbose on for debugging
-  model.verbose = true;
-
-  let resp = String(
-    await model
-      .call(
+  const modelOutput = await llmSemaphore
+    .run(() =>
+      model.call(
         `${preamble}  
        
        Below are relevant details about ${name}'s past:
@@ -131,10 +154,26 @@ export async function POST(request: Request) {
 
        ${recentChatHistory}
        ### ${name}:
-       `
+       `,
+        undefined,
+        CallbackManager.fromHandlers(handlers)
       )
-      .catch(console.error)
-  );
+    )
+    .catch((err) => {
+      console.error("ERROR: Replicate call failed.", err);
+    });
+  if (modelOutput === undefined) {
+    return new NextResponse(
+      JSON.stringify({ Message: "The companion failed to reply." }),
+      {
+        status: 500,
+        headers: {
+          "Content-Type": "application/json",
+        },
+      }
+    );
+  }
+  let resp = String(modelOutput);
 
   // Right now just using super shoddy string manip logic to get at
   // the dialog.
@@ -144,15 +183,11 @@ export async function POST(request: Request) {
   const response = chunks[0];
   // const response = chunks.length > 1 ? chunks[0] : chunks[0];
 
-  await memoryManager.writeToHistory("### " + response.trim(), companionKey);
-  var Readable = require("stream").Readable;
-
-  let s = new Readable();
-  s.push(response);
-  s.push(null);
+  // Only replies that are worth keeping in history are cached.
   if (response !== undefined && response.length > 1) {
+    responseCache.set(responseCacheKey, response);
     await memoryManager.writeToHistory("### " + response.trim(), companionKey);
   }
 
-  return new StreamingTextResponse(s);
+  return new StreamingTextResponse(textToStream(response));
 }
@@ -0,0 +1,57 @@
+type PendingRequest<I, O> = {
+  item: I;
+  resolve: (output: O) => void;
+  reject: (err: unknown) => void;
+};
+
+// Coalesces items submitted within a short window into a single call to
+// processBatch, so concurrent chat turns share one round trip instead of
+// paying the fixed per-request overhead each. processBatch must return one
+// output per item, in the same order.
+class RequestBatcher<I, O> {
+  private pending: PendingRequest<I, O>[] = [];
+  private timer?: ReturnType<typeof setTimeout>;
+
+  public constructor(
+    private processBatch: (items: I[]) => Promise<O[]>,
+    private windowMs: number = 5,
+    private maxBatchSize: number = 32
+  ) {}
+
+  public submit(item: I): Promise<O> {
+    return new Promise((resolve, reject) => {
+      this.pending.push({ item, resolve, reject });
+      if (this.pending.length >= this.maxBatchSize) {
+        this.flush();
+      } else if (!this.timer) {
+        this.timer = setTimeout(() => this.flush(), this.windowMs);
+      }
+    });
+  }
+
+  private flush() {
+    if (this.timer) {
+      clearTimeout(this.timer);
+      this.timer = undefined;
+    }
+
+    const batch = this.pending.splice(0, this.maxBatchSize);
+    if (this.pending.length !== 0) {
+      this.timer = setTimeout(() => this.flush(), this.windowMs);
+    }
+    if (batch.length === 0) {
+      return;
+    }
+
+    this.processBatch(batch.map((request) => request.item)).then(
+      (outputs) => {
+        batch.forEach((request, i) => request.resolve(outputs[i]));
+      },
+      (err) => {
+        batch.forEach((request) => request.reject(err));
+      }
+    );
+  }
+}
+
+export default RequestBatcher;
@@ -0,0 +1,67 @@
+import { createHash } from "crypto";
+
+type CacheEntry<V> = {
+  value: V;
+  expiresAt: number;
+};
+
+// Small in-process LRU cache with a time-to-live per entry. A Map keeps its
+// keys in insertion order, so re-inserting a key on every read keeps the least
+// recently used entry at the front, ready to be evicted.
+class TTLCache<V> {
+  private entries = new Map<string, CacheEntry<V>>();
+  private hits = 0;
+  private misses = 0;
+
+  public constructor(private maxSize: number, private ttlMs: number) {}
+
+  public get(key: string): V | undefined {
+    const entry = this.entries.get(key);
+    if (!entry || entry.expiresAt <= Date.now()) {
+      if (entry) {
+        this.entries.delete(key);
+      }
+      this.misses += 1;
+      return undefined;
+    }
+
+    this.entries.delete(key);
+    this.entries.set(key, entry);
+    this.hits += 1;
+    return entry.value;
+  }
+
+  public set(key: string, value: V) {
+    this.entries.delete(key);
+    if (this.entries.size >= this.maxSize) {
+      const oldestKey = this.entries.keys().next().value;
+      if (oldestKey !== undefined) {
+        this.entries.delete(oldestKey);
+      }
+    }
+    this.entries.set(key, { value, expiresAt: Date.now() + this.ttlMs });
+  }
+
+  public stats() {
+    return { hits: this.hits, misses: this.misses, size: this.entries.size };
+  }
+}
+
+// Combines the inputs that determine a value into a compact cache key. The
+// parts are JSON-encoded rather than joined with a separator, so user-written
+// text containing that separator cannot make two different inputs collide.
+export function hashCacheKey(...parts: string[]): string {
+  return createHash("blake2b512")
+    .update(JSON.stringify(parts))
+    .digest("hex");
+}
+
+// Finished LLM replies, keyed by model, companion, preamble and recent chat
+// history. History is a Redis sorted set that already holds the previous
+// reply, so later turns (including retries) never repeat a key; what does hit
+// is an identical opening message right after the seed chat, e.g. the same
+// first question to a companion from different users. Editing a companion's
+// preamble changes the key.
+export const responseCache = new TTLCache<string>(2048, 60 * 60 * 1000);
+
+export default TTLCache;
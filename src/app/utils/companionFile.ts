@@ -0,0 +1,56 @@
+import { promises as fs } from "fs";
+
+export type CompanionFile = {
+  preamble: string;
+  seedchat: string;
+};
+
+type CachedCompanionFile = {
+  mtimeMs: number;
+  companionFile: CompanionFile;
+};
+
+const companionFiles = new Map<string, CachedCompanionFile>();
+
+// Break out the PREAMBLE and SEEDCHAT sections from a character file. A single
+// indexOf per delimiter avoids building the intermediate split arrays.
+function parseCompanionFile(data: string): CompanionFile {
+  const preambleEnd = data.indexOf("###ENDPREAMBLE###");
+  if (preambleEnd === -1) {
+    return { preamble: data, seedchat: "" };
+  }
+
+  const seedchatStart = preambleEnd + "###ENDPREAMBLE###".length;
+  const seedchatEnd = data.indexOf("###ENDSEEDCHAT###", seedchatStart);
+  return {
+    preamble: data.slice(0, preambleEnd),
+    seedchat: data.slice(
+      seedchatStart,
+      seedchatEnd === -1 ? data.length : seedchatEnd
+    ),
+  };
+}
+
+// Load character "PREAMBLE" from character file. These are the core personality
+// characteristics that are used in every prompt. Additional background is
+// only included if it matches a similarity comparioson with the current
+// discussion. The PREAMBLE should include a seed conversation whose format will
+// vary by the model using it.
+//
+// Parsed files are kept in memory and only re-read when their modification
+// time changes, so edits to a companion still show up without a restart.
+export async function loadCompanionFile(
+  companionFileName: string
+): Promise<CompanionFile> {
+  const filePath = "companions/" + companionFileName;
+  const { mtimeMs } = await fs.stat(filePath);
+  const cached = companionFiles.get(filePath);
+  if (cached && cached.mtimeMs === mtimeMs) {
+    return cached.companionFile;
+  }
+
+  const data = await fs.readFile(filePath, "utf8");
+  const companionFile = parseCompanionFile(data);
+  companionFiles.set(filePath, { mtimeMs, companionFile });
+  return companionFile;
+}
@@ -0,0 +1,18 @@
+import https from "https";
+
+// Shared connection pool for OpenAI embedding requests. Node 18 (our Docker
+// base image) does not keep connections alive by default, so without this
+// every embedding request pays for a fresh TCP + TLS handshake. Streaming
+// completions go through langchain's fetch adapter, which ignores the agent.
+export const httpsAgent = new https.Agent({
+  keepAlive: true,
+  maxSockets: 1000,
+  maxFreeSockets: 200,
+  timeout: 30_000,
+});
+
+// Client configuration for langchain's OpenAIEmbeddings, which passes
+// baseOptions through to the underlying axios requests.
+export const openAIConfiguration = {
+  baseOptions: { httpsAgent },
+};
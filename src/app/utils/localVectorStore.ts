@@ -0,0 +1,181 @@
+import fs from "fs";
+import path from "path";
+import { Document } from "langchain/document";
+import { Embeddings } from "langchain/embeddings/base";
+import { VectorStore } from "langchain/vectorstores/base";
+import { CharacterTextSplitter } from "langchain/text_splitter";
+
+type LocalFilter = Record<string, unknown>;
+
+function normalize(vector: number[]): Float32Array {
+  const normalized = Float32Array.from(vector);
+  let norm = 0;
+  for (let i = 0; i < normalized.length; i++) {
+    norm += normalized[i] * normalized[i];
+  }
+  norm = Math.sqrt(norm) || 1;
+  for (let i = 0; i < normalized.length; i++) {
+    normalized[i] /= norm;
+  }
+  return normalized;
+}
+
+function matchesFilter(document: Document, filter?: LocalFilter) {
+  if (!filter) {
+    return true;
+  }
+  return Object.keys(filter).every(
+    (key) => document.metadata[key] === filter[key]
+  );
+}
+
+// In-memory vector store for local development (VECTOR_DB=local), so the app
+// can run without Pinecone or Supabase. Vectors are normalized when added,
+// which turns cosine similarity into a plain dot product, and only the best k
+// scores are kept while scanning instead of sorting them all.
+//
+// All vectors live row after row in one contiguous Float32Array, with the
+// documents in a parallel array, so a search streams through a single block
+// of memory rather than chasing one small array per document.
+class LocalVectorStore extends VectorStore {
+  declare FilterType: LocalFilter;
+
+  private matrix = new Float32Array(0);
+  private dimensions = 0;
+  private documents: Document[] = [];
+
+  public constructor(embeddings: Embeddings) {
+    super(embeddings, {});
+  }
+
+  _vectorstoreType(): string {
+    return "local";
+  }
+
+  public async addDocuments(documents: Document[]) {
+    const vectors = await this.embeddings.embedDocuments(
+      documents.map((document) => document.pageContent)
+    );
+    await this.addVectors(vectors, documents);
+  }
+
+  public async addVectors(vectors: number[][], documents: Document[]) {
+    if (vectors.length === 0) {
+      return;
+    }
+    // Validate everything up front so a bad vector leaves the store untouched.
+    const dimensions = this.dimensions || vectors[0].length;
+    vectors.forEach((vector) => {
+      if (vector.length !== dimensions) {
+        throw new Error(
+          `Expected ${dimensions}-dimensional vectors, got ${vector.length}.`
+        );
+      }
+    });
+    this.dimensions = dimensions;
+
+    const rows = this.documents.length + vectors.length;
+    const required = rows * this.dimensions;
+    if (required > this.matrix.length) {
+      // Grow geometrically so repeated adds don't copy the matrix every time.
+      const grown = new Float32Array(
+        Math.max(required, this.matrix.length * 2)
+      );
+      grown.set(this.matrix);
+      this.matrix = grown;
+    }
+
+    vectors.forEach((vector, i) => {
+      this.matrix.set(
+        normalize(vector),
+        this.documents.length * this.dimensions
+      );
+      this.documents.push(documents[i]);
+    });
+  }
+
+  public async similaritySearchVectorWithScore(
+    query: number[],
+    k: number,
+    filter?: this["FilterType"]
+  ): Promise<[Document, number][]> {
+    if (this.documents.length !== 0 && query.length !== this.dimensions) {
+      throw new Error(
+        `Expected ${this.dimensions}-dimensional vectors, got ${query.length}.`
+      );
+    }
+    const queryVector = normalize(query);
+    // Best matches so far, sorted by descending score.
+    const topIndices: number[] = [];
+    const topScores: number[] = [];
+
+    const { matrix, dimensions } = this;
+    for (let row = 0; row < this.documents.length; row++) {
+      if (!matchesFilter(this.documents[row], filter)) {
+        continue;
+      }
+
+      const offset = row * dimensions;
+      let score = 0;
+      for (let i = 0; i < dimensions; i++) {
+        score += matrix[offset + i] * queryVector[i];
+      }
+
+      if (topScores.length === k && score <= topScores[k - 1]) {
+        continue;
+      }
+      let position = topScores.length;
+      while (position > 0 && topScores[position - 1] < score) {
+        position -= 1;
+      }
+      topScores.splice(position, 0, score);
+      topIndices.splice(position, 0, row);
+      if (topScores.length > k) {
+        topScores.pop();
+        topIndices.pop();
+      }
+    }
+
+    return topIndices.map((row, i) => [this.documents[row], topScores[i]]);
+  }
+
+  // Indexes the background section of every companion file the same way the
+  // generate-embeddings scripts do for Pinecone and Supabase. Keep the
+  // splitter settings and the ###ENDSEEDCHAT### parsing in sync with
+  // src/scripts/indexPinecone.mjs and src/scripts/indexPGVector.mjs.
+  public static async fromCompanionFiles(
+    embeddings: Embeddings
+  ): Promise<LocalVectorStore> {
+    const splitter = new CharacterTextSplitter({
+      separator: " ",
+      chunkSize: 300,
+      chunkOverlap: 30,
+    });
+
+    const fileNames = (await fs.promises.readdir("companions")).filter(
+      (fileName) => fileName.endsWith(".txt")
+    );
+    const langchainDocs = await Promise.all(
+      fileNames.map(async (fileName) => {
+        const filePath = path.join("companions", fileName);
+        const fileContent = await fs.promises.readFile(filePath, "utf8");
+        const lastSection = fileContent
+          .split("###ENDSEEDCHAT###")
+          .slice(-1)[0];
+        const splitDocs = await splitter.createDocuments([lastSection]);
+        return splitDocs.map((doc) => {
+          return new Document({
+            metadata: { fileName },
+            pageContent: doc.pageContent,
+          });
+        });
+      })
+    );
+
+    const vectorStore = new LocalVectorStore(embeddings);
+    await vectorStore.addDocuments(langchainDocs.flat());
+    return vectorStore;
+  }
+}
+
+export default LocalVectorStore;
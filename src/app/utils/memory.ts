@@ -1,9 +1,21 @@
 import { Redis } from "@upstash/redis";
 import { OpenAIEmbeddings } from "langchain/embeddings/openai";
-import { PineconeClient } from "@pinecone-database/pinecone";
-import { PineconeStore } from "langchain/vectorstores/pinecone";
-import { SupabaseVectorStore } from "langchain/vectorstores/supabase";
-import { SupabaseClient, createClient } from "@supabase/supabase-js";
+import type { PineconeClient } from "@pinecone-database/pinecone";
+import type { VectorStore } from "langchain/vectorstores/base";
+import type { SupabaseClient } from "@supabase/supabase-js";
+import TTLCache from "@/app/utils/cache";
+import RequestBatcher from "@/app/utils/batcher";
+import { openAIConfiguration } from "@/app/utils/http";
+
+// Query embeddings are cached for a few hours so repeated or re-sent chat
+// histories skip the OpenAI embedding round trip.
+const EMBEDDING_CACHE_SIZE = 1024;
+const EMBEDDING_CACHE_TTL_MS = 6 * 60 * 60 * 1000;
+
+// Cache misses arriving within a few milliseconds of each other are embedded
+// together in one OpenAI request.
+const EMBEDDING_BATCH_WINDOW_MS = 5;
+const EMBEDDING_BATCH_SIZE = 32;
 
 export type CompanionKey = {
   companionName: string;
@@ -12,15 +24,42 @@ export type CompanionKey = {
 };
 
 class MemoryManager {
-  private static instance: MemoryManager;
+  private static instance?: Promise<MemoryManager>;
   private history: Redis;
-  private vectorDBClient: PineconeClient | SupabaseClient;
+  private vectorDBClient?: PineconeClient | SupabaseClient;
+  private embeddings: OpenAIEmbeddings;
+  private vectorStore?: Promise<VectorStore>;
+  private embeddingCache = new TTLCache<number[]>(
+    EMBEDDING_CACHE_SIZE,
+    EMBEDDING_CACHE_TTL_MS
+  );
+  private embeddingBatcher = new RequestBatcher<string, number[]>(
+    (queries) => this.embeddings.embedDocuments(queries),
+    EMBEDDING_BATCH_WINDOW_MS,
+    EMBEDDING_BATCH_SIZE
+  );
 
   public constructor() {
     this.history = Redis.fromEnv();
+    this.embeddings = new OpenAIEmbeddings(
+      { openAIApiKey: process.env.OPENAI_API_KEY },
+      openAIConfiguration
+    );
+  }
+
+  // Only the SDK of the configured vector DB is imported, so a worker never
+  // loads (or pays the startup cost of) clients it does not use.
+  public async init() {
     if (process.env.VECTOR_DB === "pinecone") {
-      this.vectorDBClient = new PineconeClient();
-    } else {
+      const { PineconeClient } = await import("@pinecone-database/pinecone");
+      const pineconeClient = new PineconeClient();
+      await pineconeClient.init({
+        apiKey: process.env.PINECONE_API_KEY!,
+        environment: process.env.PINECONE_ENVIRONMENT!,
+      });
+      this.vectorDBClient = pineconeClient;
+    } else if (process.env.VECTOR_DB !== "local") {
+      const { createClient } = await import("@supabase/supabase-js");
       const auth = {
         detectSessionInUrl: false,
         persistSession: false,
@@ -32,13 +71,63 @@ class MemoryManager {
     }
   }
 
-  public async init() {
-    if (this.vectorDBClient instanceof PineconeClient) {
-      await this.vectorDBClient.init({
-        apiKey: process.env.PINECONE_API_KEY!,
-        environment: process.env.PINECONE_ENVIRONMENT!,
+  private async embedQuery(query: string): Promise<number[]> {
+    // The normalized text is only the cache key; the original query is what
+    // gets embedded, matching how the indexed documents were embedded.
+    const normalizedQuery = query.trim().toLowerCase();
+    const cached = this.embeddingCache.get(normalizedQuery);
+    if (process.env.LLM_VERBOSE === "true") {
+      const { hits, misses } = this.embeddingCache.stats();
+      console.log(
+        `INFO: embedding cache ${cached ? "hit" : "miss"} (hits: ${hits}, misses: ${misses})`
+      );
+    }
+    if (cached) {
+      return cached;
+    }
+
+    const embedding = await this.embeddingBatcher.submit(query);
+    this.embeddingCache.set(normalizedQuery, embedding);
+    return embedding;
+  }
+
+  private async createVectorStore(): Promise<VectorStore> {
+    if (process.env.VECTOR_DB === "local") {
+      const { default: LocalVectorStore } = await import(
+        "@/app/utils/localVectorStore"
+      );
+      return LocalVectorStore.fromCompanionFiles(this.embeddings);
+    } else if (process.env.VECTOR_DB === "pinecone") {
+      const { PineconeStore } = await import("langchain/vectorstores/pinecone");
+      const pineconeClient = <PineconeClient>this.vectorDBClient;
+      const pineconeIndex = pineconeClient.Index(
+        process.env.PINECONE_INDEX! || ""
+      );
+      return PineconeStore.fromExistingIndex(this.embeddings, {
+        pineconeIndex,
+      });
+    } else {
+      const { SupabaseVectorStore } = await import(
+        "langchain/vectorstores/supabase"
+      );
+      return SupabaseVectorStore.fromExistingIndex(this.embeddings, {
+        client: <SupabaseClient>this.vectorDBClient,
+        tableName: "documents",
+        queryName: "match_documents",
+      });
+    }
+  }
+
+  // The vector store wraps an index handle plus the shared embeddings client,
+  // so it is built once per MemoryManager and reused by every chat turn.
+  private getVectorStore(): Promise<VectorStore> {
+    if (!this.vectorStore) {
+      this.vectorStore = this.createVectorStore();
+      this.vectorStore.catch(() => {
+        this.vectorStore = undefined;
       });
     }
+    return this.vectorStore;
   }
 
   public async vectorSearch(
@@ -47,49 +136,45 @@ class MemoryManager {
   ) {
     if (process.env.VECTOR_DB === "pinecone") {
       console.log("INFO: using Pinecone for vector search.");
-      const pineconeClient = <PineconeClient>this.vectorDBClient;
-
-      const pineconeIndex = pineconeClient.Index(
-        process.env.PINECONE_INDEX! || ""
-      );
-
-      const vectorStore = await PineconeStore.fromExistingIndex(
-        new OpenAIEmbeddings({ openAIApiKey: process.env.OPENAI_API_KEY }),
-        { pineconeIndex }
-      );
-
-      const similarDocs = await vectorStore
-        .similaritySearch(recentChatHistory, 3, { fileName: companionFileName })
-        .catch((err) => {
-          console.log("WARNING: failed to get vector search results.", err);
-        });
-      return similarDocs;
+    } else if (process.env.VECTOR_DB === "local") {
+      console.log("INFO: using the local in-memory store for vector search.");
     } else {
       console.log("INFO: using Supabase for vector search.");
-      const supabaseClient = <SupabaseClient>this.vectorDBClient;
-      const vectorStore = await SupabaseVectorStore.fromExistingIndex(
-        new OpenAIEmbeddings({ openAIApiKey: process.env.OPENAI_API_KEY }),
-        {
-          client: supabaseClient,
-          tableName: "documents",
-          queryName: "match_documents",
-        }
-      );
-      const similarDocs = await vectorStore
-        .similaritySearch(recentChatHistory, 3)
-        .catch((err) => {
-          console.log("WARNING: failed to get vector search results.", err);
-        });
-      return similarDocs;
     }
+    // Supabase's match_documents is not filtered by companion file.
+    const filter =
+      process.env.VECTOR_DB === "pinecone" || process.env.VECTOR_DB === "local"
+        ? { fileName: companionFileName }
+        : undefined;
+
+    const vectorStore = await this.getVectorStore();
+    const similarDocs = await this.embedQuery(recentChatHistory)
+      .then((embedding) =>
+        vectorStore.similaritySearchVectorWithScore(embedding, 3, filter)
+      )
+      .then((results) => results.map(([doc]) => doc))
+      .catch((err) => {
+        console.log("WARNING: failed to get vector search results.", err);
+      });
+    return similarDocs;
   }
 
-  public static async getInstance(): Promise<MemoryManager> {
-    if (!MemoryManager.instance) {
-      MemoryManager.instance = new MemoryManager();
-      await MemoryManager.instance.init();
+  public static getInstance(): Promise<MemoryManager> {
+    // Cache the pending instance so concurrent first requests share one client.
+    // A failed init is dropped so the next request retries it.
+    let instance = MemoryManager.instance;
+    if (!instance) {
+      const memoryManager = new MemoryManager();
+      instance = memoryManager
+        .init()
+        .then(() => memoryManager)
+        .catch((err) => {
+          MemoryManager.instance = undefined;
+          throw err;
+        });
+      MemoryManager.instance = instance;
     }
-    return MemoryManager.instance;
+    return instance;
   }
 
   private generateRedisCompanionKey(companionKey: CompanionKey): string {
@@ -127,6 +212,26 @@ class MemoryManager {
     return recentChats;
   }
 
+  // Every chat turn appends the user's message and then needs the updated
+  // history, so both commands go out in one pipelined Redis round trip.
+  public async writeAndReadLatestHistory(
+    text: string,
+    companionKey: CompanionKey
+  ): Promise<string> {
+    if (!companionKey || typeof companionKey.userId == "undefined") {
+      console.log("Companion key set incorrectly");
+      return "";
+    }
+
+    const key = this.generateRedisCompanionKey(companionKey);
+    const pipeline = this.history.pipeline();
+    pipeline.zadd(key, { score: Date.now(), member: text });
+    pipeline.zrange(key, 0, Date.now(), { byScore: true });
+    const [, result] = (await pipeline.exec()) as [number, string[]];
+
+    return result.slice(-30).join("\n");
+  }
+
   public async seedChatHistory(
     seedContent: String,
     delimiter: string = "\n",
@@ -138,12 +243,11 @@ class MemoryManager {
       return;
     }
 
-    const content = seedContent.split(delimiter);
-    let counter = 0;
-    for (const line of content) {
-      await this.history.zadd(key, { score: counter, member: line });
-      counter += 1;
-    }
+    // Seed every line with a single ZADD instead of one round trip per line.
+    const members = seedContent
+      .split(delimiter)
+      .map((line, counter) => ({ score: counter, member: line }));
+    await this.history.zadd(key, members[0], ...members.slice(1));
   }
 }
 
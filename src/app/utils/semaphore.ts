@@ -0,0 +1,50 @@
+// Limits how many async tasks run at once. Tasks beyond the limit wait in
+// FIFO order until a running task settles.
+class Semaphore {
+  private running = 0;
+  private waiting: (() => void)[] = [];
+
+  public constructor(private maxConcurrency: number) {}
+
+  private acquire(): Promise<void> {
+    if (this.running < this.maxConcurrency) {
+      this.running += 1;
+      return Promise.resolve();
+    }
+    return new Promise((resolve) => this.waiting.push(resolve));
+  }
+
+  private release() {
+    const next = this.waiting.shift();
+    if (next) {
+      // Hand the slot straight to the next waiter.
+      next();
+    } else {
+      this.running -= 1;
+    }
+  }
+
+  public async run<T>(task: () => Promise<T>): Promise<T> {
+    await this.acquire();
+    try {
+      return await task();
+    } finally {
+      this.release();
+    }
+  }
+}
+
+function maxLLMConcurrency(): number {
+  const configured = Number(process.env.LLM_MAX_CONCURRENCY);
+  if (!process.env.LLM_MAX_CONCURRENCY || !Number.isFinite(configured)) {
+    return 100;
+  }
+  // A limit below 1 would never admit a task, so every LLM call would hang.
+  return Math.max(1, Math.floor(configured));
+}
+
+// Shared by the model routes so outbound LLM calls from one worker stay
+// within LLM_MAX_CONCURRENCY, while everything below it overlaps freely.
+export const llmSemaphore = new Semaphore(maxLLMConcurrency());
+
+export default Semaphore;
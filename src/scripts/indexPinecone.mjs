@@ -11,17 +11,21 @@ import path from "path";
 dotenv.config({ path: `.env.local` });
 
 const fileNames = fs.readdirSync("companions");
+// Keep the splitter settings and the ###ENDSEEDCHAT### parsing below in sync
+// with indexPGVector.mjs and LocalVectorStore in src/app/utils/localVectorStore.ts.
 const splitter = new CharacterTextSplitter({
   separator: " ",
-  chunkSize: 200,
-  chunkOverlap: 50, //TODO: adjust both chunk size and chunk overlap later
+  // ~10% overlap keeps sentences that straddle a boundary retrievable without
+  // embedding and storing most of the text twice.
+  chunkSize: 300,
+  chunkOverlap: 30,
 });
 
 const langchainDocs = await Promise.all(
   fileNames.map(async (fileName) => {
     if (fileName.endsWith(".txt")) {
       const filePath = path.join("companions", fileName);
-      const fileContent = fs.readFileSync(filePath, "utf8");
+      const fileContent = await fs.promises.readFile(filePath, "utf8");
       // get the last section in the doc for background info
       const lastSection = fileContent.split("###ENDSEEDCHAT###").slice(-1)[0];
       const splitDocs = await splitter.createDocuments([lastSection]);